@@ -11,28 +11,156 @@ Unified IVR backend with conversational AI flows.
 - Replace provider placeholders (STT/TTS/LLM) with real implementations.
 """
 
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
-from typing import Dict, Any, Optional
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict, ModelWrapValidatorHandler, PrivateAttr, model_validator
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable, Final
+from dataclasses import dataclass, field, fields
 from datetime import datetime
-import uuid
+from collections import OrderedDict, deque
+from itertools import islice
+from contextlib import asynccontextmanager
+import secrets
 import asyncio
+import time
 import re
 import os
+import logging
+import logging.handlers
+import queue
+
+# Optional: orjson for response rendering (falls back to stdlib JSONResponse)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class IVRJSONResponse(JSONResponse):
+    # FastAPI runs jsonable_encoder on endpoint results before render(), so
+    # content is already plain JSON types here; orjson only does the encoding
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+# Endpoints with large payloads (history, pipeline results) return this class
+# directly: a Response returned from an endpoint skips jsonable_encoder, which
+# costs more than the encoding itself. Their content must be plain JSON types.
+IVRResponse = IVRJSONResponse if orjson is not None else JSONResponse
 
-app = FastAPI(title="IVR Conversational Backend")
+# -------------------------
+# Logging: while the app is running, handlers only enqueue and a listener
+# thread does the stream I/O; outside the lifespan records are written directly
+# -------------------------
+log = logging.getLogger("ivr")
+log.setLevel(logging.INFO)
+log.propagate = False
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log.addHandler(log_stream_handler)
+
+def start_log_listener() -> None:
+    log_listener.start()
+    log.removeHandler(log_stream_handler)
+    log.addHandler(log_queue_handler)
+
+def stop_log_listener() -> None:
+    log.removeHandler(log_queue_handler)
+    log.addHandler(log_stream_handler)
+    log_listener.stop()   # flushes anything still queued
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # background services; the start/stop helpers are defined further down
+    start_log_listener()
+    await start_recognizer()
+    start_id_pool()
+    try:
+        yield
+    finally:
+        stop_id_pool()
+        await stop_recognizer()
+        stop_log_listener()
+
+app = FastAPI(
+    title="IVR Conversational Backend",
+    default_response_class=IVRResponse,
+    lifespan=lifespan,
+)
 
 # -------------------------
 # Configuration toggles
 # -------------------------
-LLM_ENABLED = False               # set True to enable LLM-based NLU (must implement llm_nlu_parse)
+LLM_ENABLED: Final[bool] = False  # set True to enable LLM-based NLU (must implement llm_nlu_parse)
 LLM_API_KEY = os.getenv("LLM_API_KEY", None)
+LLM_ACTIVE: Final[bool] = LLM_ENABLED and bool(LLM_API_KEY)
 
 # -------------------------
 # In-memory state (simple)
 # -------------------------
-active_calls: Dict[str, Dict[str, Any]] = {}
-call_history: list = []
+@dataclass(slots=True)
+class CallSession:
+    call_id: str
+    caller: str
+    created_at: str
+    current_menu: str = "main"
+    menu_path: list = field(default_factory=lambda: ["main"])
+    conv_mode: bool = True              # conversational mode enabled by default
+    history: list = field(default_factory=list)   # NLP turn history
+    slots: dict = field(default_factory=dict)
+    last_nlu: Optional[Dict[str, Any]] = None
+    pnr_digits: int = 0                 # accumulate digits if in PNR input
+    pnr_len: int = 0
+    status: str = "active"
+    ended_at: Optional[str] = None
+    # runtime-only: outgoing TTS queue + its writer task (not part of the call record)
+    tts_q: Optional[asyncio.Queue] = field(default=None, repr=False, compare=False)
+    tts_task: Optional[asyncio.Task] = field(default=None, repr=False, compare=False)
+
+    def to_record(self) -> Dict[str, Any]:
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.name not in _SESSION_RUNTIME_FIELDS}
+
+_SESSION_RUNTIME_FIELDS = frozenset({"tts_q", "tts_task"})
+
+CALL_SHARDS = 16   # power of two, shard index is hash & (CALL_SHARDS - 1)
+
+class ShardedCalls:
+    """
+    active_calls split across CALL_SHARDS dicts, each with its own asyncio.Lock.
+    Plain get/contains are lock-free; take lock(call_id) only around
+    read-modify-write of a session (PNR digits, status transitions).
+    """
+    __slots__ = ("_shards", "_locks")
+
+    def __init__(self, n: int = CALL_SHARDS):
+        self._shards = [dict() for _ in range(n)]
+        self._locks = [asyncio.Lock() for _ in range(n)]
+
+    def _idx(self, call_id: str) -> int:
+        return hash(call_id) & (len(self._shards) - 1)
+
+    def lock(self, call_id: str) -> asyncio.Lock:
+        return self._locks[self._idx(call_id)]
+
+    def get(self, call_id: str) -> Optional[CallSession]:
+        return self._shards[self._idx(call_id)].get(call_id)
+
+    def pop(self, call_id: str, default=None):
+        return self._shards[self._idx(call_id)].pop(call_id, default)
+
+    def __setitem__(self, call_id: str, session: CallSession) -> None:
+        self._shards[self._idx(call_id)][call_id] = session
+
+    def __contains__(self, call_id) -> bool:
+        return call_id in self._shards[self._idx(call_id)]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+active_calls = ShardedCalls()
+# bounded: oldest ended calls are evicted once IVR_HISTORY_MAX is reached
+call_history: deque = deque(maxlen=int(os.getenv("IVR_HISTORY_MAX", "10000")))
+history_seq = 0   # total calls ever appended; absolute index for /ivr/history?since=
 
 # -------------------------
 # Legacy IVR Menu (you can expand)
@@ -122,6 +250,16 @@ Press 0 for Main Menu.""",
 
 }
 
+# flat lookup tables derived from MENU_STRUCTURE (one probe per DTMF / prompt)
+DTMF_TABLE: Dict[Tuple[str, str], Dict[str, Any]] = {
+    (menu, digit): opt
+    for menu, node in MENU_STRUCTURE.items()
+    for digit, opt in node.get("options", {}).items()
+}
+MENU_PROMPTS: Dict[str, str] = {menu: node["prompt"] for menu, node in MENU_STRUCTURE.items()}
+
+DTMF_DIGITS = frozenset("0123456789")
+
 # -------------------------
 # Request models
 # -------------------------
@@ -139,53 +277,170 @@ class SimSpeech(BaseModel):
 class EndCallModel(BaseModel):
     call_id: str
 
+class LiveSTT(BaseModel):
+    call_id: str
+
 # -------------------------
 # Util: small helpers
 # -------------------------
+_last_sec = 0
+_last_iso = ""
+
+def now_iso() -> str:
+    # second-resolution UTC timestamp, re-formatted only when the second changes
+    global _last_sec, _last_iso
+    sec = int(time.time())
+    if sec != _last_sec:
+        _last_sec = sec
+        _last_iso = datetime.utcfromtimestamp(sec).isoformat()
+    return _last_iso
+
+# pre-generated call ids, topped up off the request path by refill_id_pool()
+ID_POOL_LOW = 512
+ID_POOL_BATCH = 512
+ID_POOL: deque = deque()
+id_pool_task: Optional[asyncio.Task] = None
+
+def new_call_id() -> str:
+    return secrets.token_urlsafe(16)
+
+async def refill_id_pool() -> None:
+    while True:
+        if len(ID_POOL) < ID_POOL_LOW:
+            ID_POOL.extend(new_call_id() for _ in range(ID_POOL_BATCH))
+        await asyncio.sleep(0.1)
+
+def start_id_pool() -> None:
+    global id_pool_task
+    id_pool_task = asyncio.create_task(refill_id_pool())
+
+def stop_id_pool() -> None:
+    if id_pool_task is not None:
+        id_pool_task.cancel()
+
 def make_call_session(caller: str):
-    call_id = str(uuid.uuid4())
-    active_calls[call_id] = {
-        "call_id": call_id,
-        "caller": caller,
-        "created_at": datetime.utcnow().isoformat(),
-        "current_menu": "main",
-        "menu_path": ["main"],
-        "conv_mode": True,              # conversational mode enabled by default
-        "nlp_context": {"history": [], "slots": {}},
-        "pnr_buffer": "",               # accumulate digits if in PNR input
-        "status": "active"
-    }
+    call_id = ID_POOL.popleft() if ID_POOL else new_call_id()
+    active_calls[call_id] = CallSession(
+        call_id=call_id,
+        caller=caller,
+        created_at=now_iso(),
+    )
     return call_id
 
 def cleanup_call(call_id: str):
+    global history_seq
     c = active_calls.pop(call_id, None)
     if c:
-        c["ended_at"] = datetime.utcnow().isoformat()
-        call_history.append(c)
+        c.ended_at = now_iso()
+        if c.tts_task is not None and not c.tts_task.done():
+            # writer flushes whatever is still queued, then exits
+            c.tts_q.put_nowait(None)
+        call_history.append(c.to_record())
+        history_seq += 1
     return c
 
 # -------------------------
 # NLU: rule-based + optional LLM hook
 # -------------------------
+# keyword groups in priority order (first matching group wins), built once at import.
+# Plain substring tests beat a compiled alternation here: CPython's `in` is a
+# C-level fast search, while `re` retries every alternative at each position.
+INTENT_KEYWORDS = {
+    "booking": ("book", "booking", "reserve", "ticket"),
+    "status": ("pnr", "status", "flight status", "where is my flight", "flight"),
+    "agent": ("agent", "human", "representative", "operator"),
+    "greet": ("hi", "hello", "hey", "good morning", "good evening"),
+    "end": ("bye", "goodbye", "thanks", "thank you"),
+}
+PNR_RE = re.compile(r"(?<![0-9])[0-9]{6}(?![0-9])")
+
+# Optional: Numba-compiled PNR scanner (falls back to PNR_RE if numba is missing)
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    njit = None
+
+PNR_JIT_MIN_LEN = 40   # below this the encode + numpy/JIT call overhead loses to PNR_RE
+
+def _find_pnr_re(text: str) -> Optional[str]:
+    m = PNR_RE.search(text)
+    return m.group() if m else None
+
+if njit is not None:
+    @njit(cache=True)
+    def _scan_pnr(buf):
+        # index of the first run of exactly 6 ASCII digits, or -1
+        run = 0
+        for i in range(buf.shape[0]):
+            if 48 <= buf[i] <= 57:
+                run += 1
+            else:
+                if run == 6:
+                    return i - 6
+                run = 0
+        if run == 6:
+            return buf.shape[0] - 6
+        return -1
+
+    def find_pnr(text: str) -> Optional[str]:
+        if len(text) < PNR_JIT_MIN_LEN:
+            return _find_pnr_re(text)
+        # utf-8 keeps ASCII digits as single bytes, so byte offsets slice cleanly
+        raw = text.encode()
+        start = _scan_pnr(np.frombuffer(raw, dtype=np.uint8))
+        return raw[start:start + 6].decode() if start >= 0 else None
+
+    _scan_pnr(np.frombuffer(b"000000", dtype=np.uint8))  # warm the JIT at import
+else:
+    find_pnr = _find_pnr_re
+
+# Optional: Aho-Corasick automaton over every keyword (falls back to the
+# per-keyword scan if pyahocorasick is missing). One pass yields all hits.
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+INTENT_AUTOMATON = None
+if ahocorasick is not None:
+    INTENT_AUTOMATON = ahocorasick.Automaton()
+    for _prio, (_group, _kws) in enumerate(INTENT_KEYWORDS.items()):
+        for _kw in _kws:
+            if _kw not in INTENT_AUTOMATON:   # first (highest-priority) group wins
+                INTENT_AUTOMATON.add_word(_kw, (_prio, _group))
+    INTENT_AUTOMATON.make_automaton()
+
+def match_intent_group(text: str) -> Optional[str]:
+    # highest-priority INTENT_KEYWORDS group whose keyword occurs in text
+    t = text.lower()
+    if INTENT_AUTOMATON is not None:
+        best = None
+        for _, (prio, group) in INTENT_AUTOMATON.iter(t):
+            if prio == 0:
+                return group
+            if best is None or prio < best[0]:
+                best = (prio, group)
+        return best[1] if best else None
+    for group, kws in INTENT_KEYWORDS.items():
+        for kw in kws:
+            if kw in t:
+                return group
+    return None
+
 def rule_based_nlu(text: str) -> Dict[str, Any]:
-    t = text.lower().strip()
-    # simple patterns
-    if any(x in t for x in ["book", "booking", "reserve", "ticket"]):
+    group = match_intent_group(text)
+    if group == "booking":
         return {"intent": "booking_enquiry", "confidence": 0.9, "entities": {}}
-    if any(x in t for x in ["pnr", "status", "flight status", "where is my flight", "flight"]):
-        # extract digits that look like a PNR (6 digits) OR token-like alphanumeric (fallback)
-        digits = re.findall(r"\d+", t)
-        pnr = None
-        for d in digits:
-            if len(d) == 6:
-                pnr = d
-                break
+    if group == "status":
+        # first standalone run of exactly 6 digits looks like a PNR
+        pnr = find_pnr(text)
         return {"intent": "flight_status", "confidence": 0.85, "entities": {"pnr": pnr}}
-    if any(x in t for x in ["agent", "human", "representative", "operator"]):
+    if group == "agent":
         return {"intent": "agent_transfer", "confidence": 0.95, "entities": {}}
-    if any(x in t for x in ["hi","hello","hey","good morning","good evening"]):
+    if group == "greet":
         return {"intent": "greeting", "confidence": 0.8, "entities": {}}
-    if any(x in t for x in ["bye", "goodbye", "thanks", "thank you"]):
+    if group == "end":
         return {"intent": "end_call", "confidence": 0.95, "entities": {}}
     # fallback
     return {"intent": "unknown", "confidence": 0.4, "entities": {}}
@@ -199,13 +454,41 @@ async def llm_nlu_parse(text: str) -> Dict[str, Any]:
     # Example placeholder: call external LLM here using LLM_API_KEY
     # e.g., openai.ChatCompletion.create(...) or Azure OpenAI
     # keep this async for network I/O compatibility
-    await asyncio.sleep(0)  # no-op to keep function async
     return rule_based_nlu(text)
 
+# FIFO memo of NLU results keyed on the normalized transcript.
+# Cached dicts are shared between callers, treat them as read-only.
+NLU_CACHE_MAX = 2048
+nlu_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+def _nlu_cache_put(key: str, result: Dict[str, Any]) -> None:
+    # don't remember misses so they get re-evaluated after rule/model changes
+    if result.get("intent") == "unknown":
+        return
+    nlu_cache[key] = result
+    if len(nlu_cache) > NLU_CACHE_MAX:
+        nlu_cache.popitem(last=False)
+
+def rule_nlu_cached(text: str) -> Dict[str, Any]:
+    # sync fast path used when the LLM is off: no coroutine, no loop hop
+    key = text.lower().strip()
+    cached = nlu_cache.get(key)
+    if cached is not None:
+        return cached
+    result = rule_based_nlu(key)
+    _nlu_cache_put(key, result)
+    return result
+
 async def nlu_parse(text: str) -> Dict[str, Any]:
-    if LLM_ENABLED and LLM_API_KEY:
-        return await llm_nlu_parse(text)
-    return rule_based_nlu(text)
+    # LLM path only; callers pick rule_nlu_cached directly when LLM_ACTIVE is off
+    key = text.lower().strip()
+    cached = nlu_cache.get(key)
+    if cached is not None:
+        return cached
+    # key is only for the cache; the LLM sees the transcript as spoken
+    result = await llm_nlu_parse(text)
+    _nlu_cache_put(key, result)
+    return result
 
 # -------------------------
 # Dialog Manager & Intent mapping
@@ -219,56 +502,63 @@ INTENT_ACTION_MAP = {
     "unknown": {"action": "reprompt", "response": "Sorry, I didn't understand. Could you please repeat?"}
 }
 
-async def map_intent_to_action(nlu_result: Dict[str, Any], call_session: Dict[str, Any]) -> Dict[str, Any]:
-    intent = nlu_result.get("intent")
-    mapping = INTENT_ACTION_MAP.get(intent, INTENT_ACTION_MAP["unknown"])
+# Intent handlers: (nlu_result, session) -> action dict. Fixed replies are
+# built once; returned action dicts are shared, treat them as read-only.
+def _static_action(action: str, intent: str, **extra) -> Callable[[Dict[str, Any], CallSession], Dict[str, Any]]:
+    result = {"action": action, **extra, "response": INTENT_ACTION_MAP[intent]["response"]}
+    return lambda nlu_result, call_session: result
 
-    # Flight status with PNR entity -> perform lookup inline
-    if intent == "flight_status":
-        pnr = nlu_result.get("entities", {}).get("pnr")
-        if pnr:
-            # call your real PNR lookup here. For demo, mock.
-            flight_info = {"pnr": pnr, "flight": "AI101", "status": "Confirmed", "route": "Mumbai-Delhi"}
-            return {"action": "speak_and_hangup", "response": f"PNR {pnr} is confirmed. Flight {flight_info['flight']} from {flight_info['route']} is {flight_info['status']}."}
-        # else require PNR slot
-        return {"action": "ask_for_pnr", "response": mapping["response"]}
+_ASK_FOR_PNR = {"action": "ask_for_pnr", "response": INTENT_ACTION_MAP["flight_status"]["response"]}
 
+def _h_flight_status(nlu_result: Dict[str, Any], call_session: CallSession) -> Dict[str, Any]:
+    # Flight status with PNR entity -> perform lookup inline
+    pnr = nlu_result.get("entities", {}).get("pnr")
+    if pnr:
+        # call your real PNR lookup here. For demo, mock.
+        flight_info = {"pnr": pnr, "flight": "AI101", "status": "Confirmed", "route": "Mumbai-Delhi"}
+        return {"action": "speak_and_hangup", "response": f"PNR {pnr} is confirmed. Flight {flight_info['flight']} from {flight_info['route']} is {flight_info['status']}."}
+    # else require PNR slot
+    return _ASK_FOR_PNR
+
+_h_unknown = _static_action("reprompt", "unknown")
+
+INTENT_HANDLERS: Dict[str, Callable[[Dict[str, Any], CallSession], Dict[str, Any]]] = {
+    "flight_status": _h_flight_status,
     # Booking: map to booking menu (reuse legacy menus)
-    if intent == "booking_enquiry":
-        return {"action": "goto_menu", "target_menu": "booking", "response": mapping["response"]}
-
-    if intent == "agent_transfer":
-        return {"action": "transfer_agent", "response": mapping["response"]}
-
-    if intent == "end_call":
-        return {"action": "speak_and_hangup", "response": mapping["response"]}
-
-    if intent == "greeting":
-        return {"action": "speak", "response": mapping["response"]}
+    "booking_enquiry": _static_action("goto_menu", "booking_enquiry", target_menu="booking"),
+    "agent_transfer": _static_action("transfer_agent", "agent_transfer"),
+    "end_call": _static_action("speak_and_hangup", "end_call"),
+    "greeting": _static_action("speak", "greeting"),
+    "unknown": _h_unknown,
+}
 
-    return {"action": "reprompt", "response": mapping["response"]}
+def map_intent_to_action(nlu_result: Dict[str, Any], call_session: CallSession) -> Dict[str, Any]:
+    handler = INTENT_HANDLERS.get(nlu_result.get("intent"), _h_unknown)
+    return handler(nlu_result, call_session)
 
 # -------------------------
-# STT/TTS Provider placeholders (replace with real provider)
+# Call control: hang-up + background tasks
 # -------------------------
-async def play_tts_to_call(call_id: str, text: str) -> None:
-    """
-    Send TTS audio back to a live call connection.
-    Replace with provider-specific code:
-      - Azure Communication Services: call_connection.play_media(...)
-      - Twilio: <Play> with TTS URL or stream audio
-      - Google: stream audio back via WebRTC or telephony bridge
-    This placeholder simply logs and simulates a small delay.
-    """
-    print(f"[TTS] to {call_id}: {text}")
-    # simulate playback duration proportional to text length
-    await asyncio.sleep(min(3.0, max(0.5, len(text) / 80.0)))
-
 async def hangup_call(call_id: str):
-    print(f"[CALL] Hanging up {call_id}")
+    log.info("[CALL] Hanging up %s", call_id)
     # place provider hang-up code here
     cleanup_call(call_id)
 
+async def speak_then_hangup(call_id: str, text: str) -> None:
+    # play the closing prompt fully before dropping the call
+    await play_tts_to_call(call_id, text)
+    await asyncio.sleep(0.3)
+    await hangup_call(call_id)
+
+# keep strong refs to fire-and-forget tasks so they aren't garbage collected mid-flight
+background_tasks: set = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 from fastapi import BackgroundTasks
 from typing import Optional
 import httpx
@@ -301,7 +591,7 @@ async def vxml_event_handler(req: VXMLRequest):
     # Route event to conversational engine
     response = await handle_transcribed_text(ai_call_id, req.data or "")
 
-    return {"status": "ok", "ai_call_id": ai_call_id, "ai_response": response}
+    return IVRResponse({"status": "ok", "ai_call_id": ai_call_id, "ai_response": response})
 
 
 # -----------------------------------
@@ -317,7 +607,7 @@ async def send_to_acs_tts(call_id: str, text: str):
     Replace with Azure SDK call automation.
     """
     if not ACS_ENDPOINT or not ACS_KEY:
-        print("[ACS] Skipped - ACS not configured")
+        log.info("[ACS] Skipped - ACS not configured")
         return
     async with httpx.AsyncClient() as client:
         await client.post(
@@ -327,9 +617,19 @@ async def send_to_acs_tts(call_id: str, text: str):
         )
 
 
-# Modify TTS function to trigger ACS bridge too
-async def play_tts_to_call(call_id: str, text: str) -> None:
-    print(f"[TTS] to {call_id} => {text}")
+# -------------------------
+# TTS Provider placeholder (replace with real provider)
+# -------------------------
+async def provider_play_tts(call_id: str, text: str) -> None:
+    """
+    Send TTS audio back to a live call connection.
+    Replace with provider-specific code:
+      - Azure Communication Services: call_connection.play_media(...)
+      - Twilio: <Play> with TTS URL or stream audio
+      - Google: stream audio back via WebRTC or telephony bridge
+    This placeholder logs, forwards to the ACS bridge and simulates playback time.
+    """
+    log.info("[TTS] to %s => %s", call_id, text)
 
     # stream to ACS
     await send_to_acs_tts(call_id, text)
@@ -338,6 +638,68 @@ async def play_tts_to_call(call_id: str, text: str) -> None:
     await asyncio.sleep(min(3.0, max(0.5, len(text) / 80.0)))
 
 
+# Outgoing TTS is batched per call: prompts queued within TTS_BATCH_WINDOW are
+# merged (up to TTS_BATCH_MAX) into a single provider call.
+TTS_BATCH_WINDOW = 0.02   # seconds
+TTS_BATCH_MAX = 4
+TTS_WRITER_IDLE = 30.0    # seconds without prompts before a writer exits
+
+async def tts_writer(call_id: str, q: asyncio.Queue) -> None:
+    # single consumer of a call's tts_q; a None item means the call has ended.
+    # Exits when idle so abandoned sessions don't pin a task; play_tts_to_call
+    # starts a new writer on the next prompt.
+    while True:
+        try:
+            first = await asyncio.wait_for(q.get(), timeout=TTS_WRITER_IDLE)
+        except asyncio.TimeoutError:
+            if q.empty():
+                return
+            continue
+        if first is None:
+            return
+        await asyncio.sleep(TTS_BATCH_WINDOW)
+        batch = [first]
+        stop = False
+        while len(batch) < TTS_BATCH_MAX and not q.empty():
+            item = q.get_nowait()
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+
+        error = None
+        try:
+            await provider_play_tts(call_id, " ".join(text for text, _ in batch))
+        except Exception as e:
+            error = e
+        for _, done in batch:
+            if not done.done():
+                if error is None:
+                    done.set_result(None)
+                else:
+                    done.set_exception(error)
+        if stop:
+            return
+
+async def play_tts_to_call(call_id: str, text: str) -> None:
+    """
+    Queue text on the call's TTS writer and wait until it has been played.
+    The writer is started on demand. Calls that are no longer active go
+    straight to the provider.
+    """
+    session = active_calls.get(call_id)
+    if session is None:
+        await provider_play_tts(call_id, text)
+        return
+    if session.tts_task is None or session.tts_task.done():
+        if session.tts_q is None:
+            session.tts_q = asyncio.Queue()
+        session.tts_task = spawn(tts_writer(call_id, session.tts_q))
+    done = asyncio.get_running_loop().create_future()
+    session.tts_q.put_nowait((text, done))
+    await done
+
+
 # -----------------------------------
 # 3) BAP Connector - Trigger workflow
 # -----------------------------------
@@ -348,7 +710,7 @@ async def trigger_bap_event(event_name: str, payload: dict):
     Sends event to BAP workflow (Power Automate / Logic Apps).
     """
     if not BAP_WEBHOOK:
-        print("[BAP] not configured")
+        log.info("[BAP] not configured")
         return
 
     async with httpx.AsyncClient() as client:
@@ -370,6 +732,62 @@ async def integration_test():
     return {"status": "passed", "call_id": test_call}
 
 
+# -------------------------
+# Action executors: (call_id, session, action) -> outcome dict
+# -------------------------
+async def _act_goto(call_id: str, session: CallSession, action: Dict[str, Any]) -> Dict[str, Any]:
+    target = action.get("target_menu")
+    session.current_menu = target
+    session.menu_path.append(target)
+    menu_prompt = MENU_PROMPTS.get(target, action.get("response", ""))
+    await play_tts_to_call(call_id, menu_prompt)
+    return {"status": "ok", "action": "goto_menu", "menu": target, "spoken": menu_prompt}
+
+async def _act_ask_pnr(call_id: str, session: CallSession, action: Dict[str, Any]) -> Dict[str, Any]:
+    resp_text = action.get("response", "")
+    # change session so subsequent speech/dtmf is captured as PNR digits
+    session.current_menu = "flight_status"
+    await play_tts_to_call(call_id, resp_text)
+    return {"status": "ok", "action": "ask_for_pnr", "spoken": resp_text}
+
+async def _act_speak(call_id: str, session: CallSession, action: Dict[str, Any]) -> Dict[str, Any]:
+    resp_text = action.get("response", "")
+    await play_tts_to_call(call_id, resp_text)
+    return {"status": "ok", "action": "speak", "spoken": resp_text}
+
+async def _act_speak_hangup(call_id: str, session: CallSession, action: Dict[str, Any]) -> Dict[str, Any]:
+    resp_text = action.get("response", "")
+    await speak_then_hangup(call_id, resp_text)
+    return {"status": "ok", "action": "hangup", "spoken": resp_text}
+
+async def _act_transfer(call_id: str, session: CallSession, action: Dict[str, Any]) -> Dict[str, Any]:
+    resp_text = action.get("response", "")
+    await play_tts_to_call(call_id, resp_text)
+    # insert provider-specific transfer logic here (bridge to human queue)
+    async with active_calls.lock(call_id):
+        session.status = "transferring"
+    # optionally hangup local leg if PBX handles transfer
+    return {"status": "ok", "action": "transfer", "spoken": resp_text}
+
+async def _act_reprompt(call_id: str, session: CallSession, action: Dict[str, Any]) -> Dict[str, Any]:
+    resp_text = action.get("response", "")
+    await play_tts_to_call(call_id, resp_text)
+    return {"status": "ok", "action": "reprompt", "spoken": resp_text}
+
+async def _act_fallback(call_id: str, session: CallSession, action: Dict[str, Any]) -> Dict[str, Any]:
+    await play_tts_to_call(call_id, "Sorry, I couldn't handle that. Transferring to agent.")
+    return {"status": "fail", "action": "transfer", "spoken": "transferring"}
+
+ACTION_DISPATCH: Dict[str, Callable[[str, CallSession, Dict[str, Any]], Awaitable[Dict[str, Any]]]] = {
+    "goto_menu": _act_goto,
+    "ask_for_pnr": _act_ask_pnr,
+    "speak": _act_speak,
+    "speak_and_hangup": _act_speak_hangup,
+    "transfer_agent": _act_transfer,
+    "reprompt": _act_reprompt,
+    "unknown": _act_reprompt,
+}
+
 # -------------------------
 # Conversational handler (core)
 # -------------------------
@@ -387,58 +805,18 @@ async def handle_transcribed_text(call_id: str, transcript: str) -> Dict[str, An
         raise ValueError("Unknown call_id")
 
     # store transcript
-    session["nlp_context"]["history"].append({"from": "user", "text": transcript, "ts": datetime.utcnow().isoformat()})
+    session.history.append({"from": "user", "text": transcript, "ts": now_iso()})
 
     # Run NLU
-    nlu_result = await nlu_parse(transcript)
-    session["nlp_context"]["last_nlu"] = nlu_result
+    nlu_result = await nlu_parse(transcript) if LLM_ACTIVE else rule_nlu_cached(transcript)
+    session.last_nlu = nlu_result
 
     # Map to action
-    action = await map_intent_to_action(nlu_result, session)
+    action = map_intent_to_action(nlu_result, session)
 
     # Execute action
-    act = action.get("action")
-    resp_text = action.get("response", "")
-
-    # ACTIONS:
-    if act == "goto_menu":
-        target = action.get("target_menu")
-        session["current_menu"] = target
-        session["menu_path"].append(target)
-        menu_prompt = MENU_STRUCTURE.get(target, {}).get("prompt", resp_text)
-        await play_tts_to_call(call_id, menu_prompt)
-        return {"status": "ok", "action": "goto_menu", "menu": target, "spoken": menu_prompt}
-
-    if act == "ask_for_pnr":
-        # change session so subsequent speech/dtmf is captured as PNR digits
-        session["current_menu"] = "flight_status"
-        await play_tts_to_call(call_id, resp_text)
-        return {"status": "ok", "action": "ask_for_pnr", "spoken": resp_text}
-
-    if act == "speak":
-        await play_tts_to_call(call_id, resp_text)
-        return {"status": "ok", "action": "speak", "spoken": resp_text}
-
-    if act == "speak_and_hangup":
-        await play_tts_to_call(call_id, resp_text)
-        await asyncio.sleep(0.3)
-        await hangup_call(call_id)
-        return {"status": "ok", "action": "hangup", "spoken": resp_text}
-
-    if act == "transfer_agent":
-        await play_tts_to_call(call_id, resp_text)
-        # insert provider-specific transfer logic here (bridge to human queue)
-        session["status"] = "transferring"
-        # optionally hangup local leg if PBX handles transfer
-        return {"status": "ok", "action": "transfer", "spoken": resp_text}
-
-    if act == "reprompt" or act == "unknown":
-        await play_tts_to_call(call_id, resp_text)
-        return {"status": "ok", "action": "reprompt", "spoken": resp_text}
-
-    # default fallback
-    await play_tts_to_call(call_id, "Sorry, I couldn't handle that. Transferring to agent.")
-    return {"status": "fail", "action": "transfer", "spoken": "transferring"}
+    execute = ACTION_DISPATCH.get(action.get("action"), _act_fallback)
+    return await execute(call_id, session, action)
 # -------------------------
 # REAL SPEECH-TO-TEXT (AZURE SPEECH SDK)
 # -------------------------
@@ -454,31 +832,96 @@ speech_config = speechsdk.SpeechConfig(
 )
 speech_config.speech_recognition_language = "en-IN"
 
+# one long-lived continuous recognizer on the default mic. A second one would
+# hear the same audio and emit every utterance twice, so this is an on/off switch.
+STT_CONTINUOUS = os.getenv("STT_CONTINUOUS", "1") != "0"
+STT_LISTEN_TIMEOUT = 15.0       # seconds to wait for an utterance
+
+continuous_recognizer = None
+stt_queue: "asyncio.Queue[str]" = asyncio.Queue()
+stt_lock = asyncio.Lock()       # one /ivr/live_stt request listens at a time
+
+def _wire_recognizer(recognizer, loop: asyncio.AbstractEventLoop) -> None:
+    def on_recognized(evt):
+        # runs on an SDK worker thread -> hop back onto the event loop
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+            loop.call_soon_threadsafe(stt_queue.put_nowait, evt.result.text)
+    recognizer.recognized.connect(on_recognized)
+
+async def start_recognizer() -> None:
+    global continuous_recognizer
+    if not STT_CONTINUOUS:
+        return
+    if not AZURE_SPEECH_KEY or not AZURE_SPEECH_REGION:
+        log.info("[STT] Skipped - Azure Speech not configured")
+        return
+    try:
+        recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config)
+        _wire_recognizer(recognizer, asyncio.get_running_loop())
+        await asyncio.to_thread(recognizer.start_continuous_recognition_async().get)
+    except Exception as e:
+        # e.g. no audio input device; live STT falls back to single-shot
+        log.warning("[STT] Continuous recognizer failed to start, using single-shot: %s", e)
+        return
+    continuous_recognizer = recognizer
+
+async def stop_recognizer() -> None:
+    global continuous_recognizer
+    recognizer, continuous_recognizer = continuous_recognizer, None
+    if recognizer is not None:
+        await asyncio.to_thread(recognizer.stop_continuous_recognition_async().get)
+    # drop utterances left over from the stopped recognizer
+    while not stt_queue.empty():
+        stt_queue.get_nowait()
+
+def _recognize_once_blocking():
+    # SDK construction + .get() both block; only ever call via asyncio.to_thread
+    recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config)
+    return recognizer.recognize_once_async().get()
+
+async def _transcribe_single_shot() -> str:
+    log.info("🎤 Listening... speak now...")
+    try:
+        # on timeout the worker thread finishes in the background, the loop is not held
+        result = await asyncio.wait_for(asyncio.to_thread(_recognize_once_blocking), timeout=STT_LISTEN_TIMEOUT)
+    except asyncio.TimeoutError:
+        return ""
+    if result.reason == speechsdk.ResultReason.RecognizedSpeech:
+        log.info("✅ Recognized: %s", result.text)
+        return result.text
+    return ""
+
 async def transcribe_speech() -> str:
     """
     Real-time STT using Azure Speech SDK.
     Works for mic input or telephony streamed audio.
+    Waits for the next utterance from the continuous recognizer, or falls back to
+    a one-off recognizer when continuous recognition is off or failed to start.
     """
-    recognizer = speechsdk.SpeechRecognizer(speech_config=speech_config)
+    if continuous_recognizer is None:
+        return await _transcribe_single_shot()
 
-    print("🎤 Listening... speak now...")
-    result = recognizer.recognize_once_async().get()
+    async with stt_lock:
+        # drop utterances nobody was waiting for
+        while not stt_queue.empty():
+            stt_queue.get_nowait()
+
+        log.info("🎤 Listening... speak now...")
+        try:
+            text = await asyncio.wait_for(stt_queue.get(), timeout=STT_LISTEN_TIMEOUT)
+        except asyncio.TimeoutError:
+            return ""
+
+        log.info("✅ Recognized: %s", text)
+        return text
 
-    if result.reason == speechsdk.ResultReason.RecognizedSpeech:
-        print(f"✅ Recognized: {result.text}")
-        return result.text
-    elif result.reason == speechsdk.ResultReason.NoMatch:
-        return ""
-    else:
-        return ""
 @app.post("/ivr/live_stt")
-async def live_stt(request: Request):
+async def live_stt(body: LiveSTT):
     """
     Real-time mic STT injection. Test endpoint.
     It listens from mic, transcribes, injects into IVR pipeline.
     """
-    body = await request.json()
-    call_id = body.get("call_id")
+    call_id = body.call_id
 
     if call_id not in active_calls:
         raise HTTPException(status_code=404, detail="Call not found")
@@ -489,74 +932,78 @@ async def live_stt(request: Request):
         return {"status": "no_speech_detected"}
 
     result = await handle_transcribed_text(call_id, transcript)
-    return {
+    return IVRResponse({
         "stt_text": transcript,
         "ivr_response": result
-    }
+    })
 
 
 # -------------------------
 # REST endpoints
 # -------------------------
 @app.post("/ivr/start")
-def start_call(req: StartCall):
+async def start_call(req: StartCall):
     call_id = make_call_session(req.caller)
-    prompt = MENU_STRUCTURE["main"]["prompt"]
+    prompt = MENU_PROMPTS["main"]
     # In real integration: you might immediately play TTS to the call via provider
     return {"call_id": call_id, "initial_prompt": prompt}
 
 @app.post("/ivr/dtmf")
-def dtmf_endpoint(inp: DTMFInput):
+async def dtmf_endpoint(inp: DTMFInput):
     """
-    Handle legacy DTMF input. Uses MENU_STRUCTURE mapping and also integrates
+    Handle legacy DTMF input. Uses DTMF_TABLE mapping and also integrates
     with conversational mode (e.g., entering digits while asking for PNR).
     """
     call = active_calls.get(inp.call_id)
     if not call:
         raise HTTPException(status_code=404, detail="Call not found")
 
-    menu = call["current_menu"]
+    menu = call.current_menu
     digit = inp.digit
 
     # If inside flight_status expecting digits, accumulate
-    if menu == "flight_status" and digit.isdigit():
-        call["pnr_buffer"] += digit
-        if len(call["pnr_buffer"]) == 6:
-            pnr = call["pnr_buffer"]
-            call["pnr_buffer"] = ""
+    if menu == "flight_status" and digit in DTMF_DIGITS:
+        async with active_calls.lock(inp.call_id):
+            call.pnr_digits = call.pnr_digits * 10 + ord(digit) - 48
+            call.pnr_len += 1
+            pnr_len = call.pnr_len
+            if pnr_len == 6:
+                pnr = f"{call.pnr_digits:06d}"
+                call.pnr_digits = 0
+                call.pnr_len = 0
+        if pnr_len == 6:
             # mock lookup
             response = f"PNR {pnr} is confirmed. Flight AI101 is on time."
             # play and hangup
-            asyncio.create_task(play_tts_to_call(inp.call_id, response))
-            asyncio.create_task(hangup_call(inp.call_id))
+            spawn(speak_then_hangup(inp.call_id, response))
             return {"action": "pnr_lookup", "message": response}
 
         # else ask for more digits
-        remaining = 6 - len(call["pnr_buffer"])
+        remaining = 6 - pnr_len
         return {"message": f"Received digit. {remaining} digits to go."}
 
     # Standard menu option handling
-    opt = MENU_STRUCTURE.get(menu, {}).get("options", {}).get(digit)
+    opt = DTMF_TABLE.get((menu, digit))
     if not opt:
         return {"message": "Invalid choice, please try again."}
 
     if opt["action"] == "goto_menu":
-        call["current_menu"] = opt["target"]
-        call["menu_path"].append(opt["target"])
-        prompt = MENU_STRUCTURE[opt["target"]]["prompt"]
+        call.current_menu = opt["target"]
+        call.menu_path.append(opt["target"])
+        prompt = MENU_PROMPTS[opt["target"]]
         # in production, play TTS to the call; here just return prompt
-        asyncio.create_task(play_tts_to_call(inp.call_id, prompt))
+        spawn(play_tts_to_call(inp.call_id, prompt))
         return {"message": prompt}
 
     if opt["action"] == "transfer_agent":
-        asyncio.create_task(play_tts_to_call(inp.call_id, opt.get("message", "Transferring")))
+        spawn(play_tts_to_call(inp.call_id, opt.get("message", "Transferring")))
         # provider-specific transfer logic goes here
-        call["status"] = "transferring"
+        async with active_calls.lock(inp.call_id):
+            call.status = "transferring"
         return {"message": "transfer initiated"}
 
     if opt["action"] == "end_call":
-        asyncio.create_task(play_tts_to_call(inp.call_id, opt.get("message", "Goodbye")))
-        asyncio.create_task(hangup_call(inp.call_id))
+        spawn(speak_then_hangup(inp.call_id, opt.get("message", "Goodbye")))
         return {"message": "call ended"}
 
     return {"message": "Unhandled DTMF action"}
@@ -570,10 +1017,60 @@ async def simulate_speech(inp: SimSpeech):
     if inp.call_id not in active_calls:
         raise HTTPException(status_code=404, detail="Call not active")
     res = await handle_transcribed_text(inp.call_id, inp.transcript)
-    return res
+    return IVRResponse(res)
+
+def _generic_transcript(p: Dict[str, Any]) -> Optional[str]:
+    # Generic: try keys
+    return p.get("transcript") or p.get("text") or p.get("recognizedText")
+
+# STT provider payload adapters: (signature key, extractor -> (call_id, transcript)).
+# Ordered by expected traffic; the first key present in the payload wins. Provider
+# extractors fall back to the generic keys when their own transcript is empty.
+PROVIDER_ADAPTERS = [
+    # Azure event: { "type": "...", "recognizeResult": {"text": "..."}, "callConnectionId": "<id>"}
+    ("callConnectionId", lambda p: (p["callConnectionId"], (p.get("recognizeResult") or {}).get("text") or _generic_transcript(p))),
+    # Twilio might post: {"CallSid": "...", "SpeechResult":"..."}
+    ("CallSid", lambda p: (p["CallSid"], p.get("SpeechResult") or _generic_transcript(p))),
+    # Generic / simulator: {"call_id": "...", "transcript": "..."}
+    ("call_id", lambda p: (p["call_id"], _generic_transcript(p))),
+]
+
+class STTCallback(BaseModel):
+    """
+    Provider STT webhook normalized to call_id/transcript in one validation pass.
+    Provider-specific keys are kept as extras; received_keys lists exactly what
+    the client sent (used for diagnostics).
+    """
+    model_config = ConfigDict(extra="allow")
+
+    call_id: Optional[str] = None
+    transcript: Optional[str] = None
+    _received_keys: List[str] = PrivateAttr(default_factory=list)
+
+    @property
+    def received_keys(self) -> List[str]:
+        return self._received_keys
+
+    @model_validator(mode="wrap")
+    @classmethod
+    def _from_provider(cls, payload: Any, handler: ModelWrapValidatorHandler["STTCallback"]) -> "STTCallback":
+        if not isinstance(payload, dict):
+            return handler(payload)
+        data = payload
+        for key, extract in PROVIDER_ADAPTERS:
+            if key in payload:
+                try:
+                    call_id, transcript = extract(payload)
+                except (AttributeError, TypeError) as e:
+                    raise ValueError(f"malformed {key} payload: {e}") from e
+                data = {**payload, "call_id": call_id, "transcript": transcript}
+                break
+        model = handler(data)
+        model._received_keys = list(payload)
+        return model
 
 @app.post("/ivr/stt_callback")
-async def stt_callback(request: Request):
+async def stt_callback(body: STTCallback):
     """
     Generic STT callback receiver for real STT providers (ACS/Twilio).
     The exact payload depends on provider:
@@ -581,46 +1078,43 @@ async def stt_callback(request: Request):
     - Twilio: use <Stream> or speech recognition webhook.
     Map provider payload to {"call_id":..., "transcript": "..."}
     """
-    payload = await request.json()
-    # Provider-specific mapping required. Here, we attempt some common shapes:
-    call_id = None
-    transcript = None
-
-    # Example Azure event: { "type": "...", "recognizeResult": {"text": "..."}, "callConnectionId": "<id>"}
-    if isinstance(payload, dict):
-        if "callConnectionId" in payload and "recognizeResult" in payload:
-            call_id = payload.get("callConnectionId")
-            transcript = payload["recognizeResult"].get("text")
-        # Twilio might post: {"CallSid": "...", "SpeechResult":"..."}
-        if not transcript and "CallSid" in payload and "SpeechResult" in payload:
-            call_id = payload.get("CallSid")
-            transcript = payload.get("SpeechResult")
-        # Generic: try keys
-        if not transcript:
-            transcript = payload.get("transcript") or payload.get("text") or payload.get("recognizedText")
+    # Provider-specific mapping happens in STTCallback (see PROVIDER_ADAPTERS)
+    call_id = body.call_id
+    transcript = body.transcript
 
     if not call_id or not transcript:
         # We couldn't parse provider payload; return 400 with diagnostics
-        raise HTTPException(status_code=400, detail=f"Could not parse STT payload. Received keys: {list(payload.keys())}")
+        keys = body.received_keys
+        log.warning("[STT] Unparseable callback payload, keys: %s", keys)
+        raise HTTPException(status_code=400, detail=f"Could not parse STT payload. Received keys: {keys}")
 
     # Ensure call exists
     if call_id not in active_calls:
-        # sometimes call ids differ between provider and our internal uuid.
+        # sometimes call ids differ between provider and our internal call id.
         # If you use provider call ids, store mapping when starting call.
         raise HTTPException(status_code=404, detail="Call session not found")
 
     # handle in background so webhook returns quickly
-    asyncio.create_task(handle_transcribed_text(call_id, transcript))
+    spawn(handle_transcribed_text(call_id, transcript))
     return {"status": "accepted"}
 
 @app.post("/ivr/end")
-def end_call(req: EndCallModel):
+async def end_call(req: EndCallModel):
     cleanup_call(req.call_id)
     return {"status": "call ended"}
 
 @app.get("/ivr/history")
-def get_history():
-    return {"history": call_history, "active_count": len(active_calls)}
+async def get_history(since: Optional[int] = None):
+    """
+    Ended-call log. Pass ?since=<next> from a previous response to fetch only
+    entries added after it instead of the whole retained window.
+    """
+    if since is None:
+        entries = list(call_history)
+    else:
+        first = history_seq - len(call_history)   # absolute index of call_history[0]
+        entries = list(islice(call_history, max(0, since - first), None))
+    return IVRResponse({"history": entries, "next": history_seq, "active_count": len(active_calls)})
 
 
 